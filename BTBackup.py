@@ -5,46 +5,76 @@ Requires youtube-dl as an installed Python module. https://youtube-dl.org/
 """
 
 import argparse
+import collections
+import concurrent.futures
 import os
 import pathlib
 import re
 import sys
+import threading
 import urllib.request
 import youtube_dl
 
 from ChatLogReader import ChatLogReader
 
+# log lines are bytes; matching on bytes means only the parts we keep get decoded
+_NOW_PLAYING = b"Now Playing:"
+# (delimiter between title and id, source) for every video site the logs link to
+_DELIMS = (
+    (b" ( https://youtu.be/", 'yt'),
+    (b" ( https://vimeo.com/", 'vimeo'),
+)
+
+# sorts youtube-dl error messages into the sections processErrors prints
+_ERR_CLASSIFIER = re.compile(
+    r'(?P<unavailable>This video is unavailable\.|This video is no longer available|Unable to download webpage)'
+    r'|(?P<copyright>blocked it on copyright grounds)'
+    r'|(?P<region>not available in your country)')
+
 class Video(object):
-    episodeRegex = re.compile(r'^\dx\d\d$')
+    episodeRegex = re.compile(rb'^\dx\d\d$')
 
-    def __init__(self, logLine):
-        title, vidId, source = self.parseLogLine(logLine)
-        self.title = title
+    def __init__(self, titleBytes, vidId, source, playCount=1):
+        self.titleBytes = titleBytes
+        self._title = None
         self.vidId = vidId
         self.source = source
-        self.playCount = 1
-        self.isAnEpisode = Video.episodeRegex.match(self.title)
-
-    def parseLogLine(self, logLine):
-        payload = logLine.decode('utf-8').strip().split("Now Playing:")[1]
-        youtubeDelimiter = " ( https://youtu.be/"
-        vimeoDelimiter = " ( https://vimeo.com/"
-        if youtubeDelimiter in payload:
-            title, vidId = payload.split(youtubeDelimiter)
-            return title, vidId, 'yt'
-        elif vimeoDelimiter in payload:
-            title, vidId =  payload.split(vimeoDelimiter)
-            return title, vidId, 'vimeo'
-        else:
-            raise ValueError("Unrecognized video site {}".format(payload))
-
-    def incrementCount(self):
-        self.playCount += 1
+        self.playCount = playCount
+        self.isAnEpisode = Video.episodeRegex.match(titleBytes)
+
+    @property
+    def title(self):
+        """The title is only printed for failed downloads, so decode it on first use."""
+        if self._title is None:
+            self._title = self.titleBytes.decode('utf-8', errors='replace')
+        return self._title
+
+    @staticmethod
+    def parseLogLine(logLine):
+        """
+        Split a 'Now Playing' chat log line into (title, vidId, source).
+        The title is left as bytes, since most videos never need it.
+        Returns None if the line can't be parsed.
+        """
+        _, sep, payload = logLine.strip().partition(_NOW_PLAYING)
+        if not sep:
+            return None
+        for delimiter, source in _DELIMS:
+            title, sep, vidId = payload.partition(delimiter)
+            if sep:
+                try:
+                    return title, vidId.decode('utf-8'), source
+                except UnicodeDecodeError:
+                    return None
+        return None
 
 
 class Logger(object):
     def __init__(self):
         self.errors = []
+        # (vidId, message) pairs; kept apart from errors because a failed merge says
+        # nothing about whether the video is still available
+        self.postProcessingErrors = []
         self.ydl = None
 
     def to_stdout(self, message, skip_eol=False, check_quiet=False):
@@ -72,72 +102,180 @@ class Logger(object):
         self.errors.append(msg)
         self.to_stderr(msg)
 
+    def postProcessingError(self, vidId, msg):
+        self.postProcessingErrors.append((vidId, msg))
+        self.to_stderr('ERROR: postprocessing {}: {}'.format(vidId, msg))
+
 
 def parseArgs():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-t', '--target', metavar='<directory>', type=str, dest='targetDirectory', required=True,
             help='directory to put the downloaded videos.  Will be created if it does not exist.')
-    parser.add_argument('-r', '--requiredPlays', metavar='<integer>', type=int, dest='requiredPlays', required=False,
-            help='number of plays a single video needs to have to warrant backing up.')
+    parser.add_argument('-r', '--requiredPlays', metavar='<integer>', type=int, dest='requiredPlays', default=5,
+            help='number of plays a single video needs to have to warrant backing up.  Defaults to 5.')
     parser.add_argument('-y', '--yes', action="store_true", dest='noPrompt', 
             help="automatically say yes to the 'are you sure?' prompt")
     parser.add_argument( '--no-progress', action="store_true", dest='noProgress', 
             help="Do not print progress bar (useful for Jenkins)")
-    return parser.parse_args()
-
-
-def getVideosById():
+    parser.add_argument('-j', '--jobs', metavar='<integer>', type=int, dest='jobs', default=4,
+            help='number of videos to download at the same time.  Defaults to 4.')
+    args = parser.parse_args()
+    # checked here so a bad value fails before the chat logs are downloaded
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    return args
+
+
+def getVideoPlays():
+    """
+    Count the plays of every video in the chat logs.
+    Returns the play counts by vidId, and the (title, source) each vidId was
+    first played with.  Video objects are only built later for the videos
+    that survive filtering.
+    """
     print("Parsing videos from chat logs...")
-    videosById = {}
+    playCounts = collections.Counter()
+    playedVideos = {}
     errors = []
     logReader = ChatLogReader()
     for line in logReader.listAllVideoPlayLines():
-        try:
-            video = Video(line)
-        except:
+        fields = Video.parseLogLine(line)
+        if fields is None:
             errors.append(line)
             continue
-        if video.vidId in videosById:
-            videosById[video.vidId].incrementCount()
-        else:
-            videosById[video.vidId] = video
+        title, vidId, source = fields
+        playCounts[vidId] += 1
+        if vidId not in playedVideos:
+            playedVideos[vidId] = (title, source)
     if len(errors) > 0:
         print("Unable to parse {} chat log lines".format(len(errors)))
     print("done.")
-    return videosById
+    return playCounts, playedVideos
 
 
 def getAlreadyDownloadedVidIds(targetDirectory):
     if not os.path.isdir(targetDirectory):
-        return []
-    return [parseId(v) for v in os.listdir(targetDirectory)]
+        return set()
+    return {parseId(v) for v in os.listdir(targetDirectory)}
 
 
 def parseId(vidTitle):
-    idPartition = vidTitle.split(' - ')[-1]
+    idPartition = vidTitle.rpartition(' - ')[2]
     return idPartition[:idPartition.find('.')]
 
 
 def readInUnavailableVideos():
     try:
-        with open("unavailableVideos.txt") as f:
-            return set([v.strip() for v in f.readlines()])
+        return frozenset(pathlib.Path("unavailableVideos.txt").read_text().splitlines())
     except FileNotFoundError:
-        return set()
+        return frozenset()
 
 
-def filterVideos(videosById, alreadyDownloadedIds, knownUnavailableIds, requiredPlays):
-    def videoShouldBeDownloaded(v):
-        return v.playCount >= requiredPlays \
-               and v.vidId not in alreadyDownloadedIds \
-               and v.vidId not in knownUnavailableIds \
-               and not v.isAnEpisode
-
+def filterVideos(playCounts, playedVideos, skippedIds, requiredPlays):
+    """
+    Build the Videos that have enough plays and aren't in skippedIds
+    (already downloaded or known to be unavailable).
+    """
     print("Filtering out videos with fewer than {} plays.".format(requiredPlays))
-    return [v for v in videosById.values() if videoShouldBeDownloaded(v)]
+    videos = []
+    for vidId, playCount in playCounts.items():
+        if playCount < requiredPlays or vidId in skippedIds:
+            continue
+        title, source = playedVideos[vidId]
+        video = Video(title, vidId, source, playCount)
+        if not video.isAnEpisode:
+            videos.append(video)
+    return videos
+
+
+class BackgroundPostProcessingYoutubeDL(youtube_dl.YoutubeDL):
+    """
+    A YoutubeDL that hands ffmpeg post processing (merging, fixups) to a pool
+    so the next video can start downloading while the last one is converted.
+    """
+    def __init__(self, params, postProcessPool, progress):
+        super().__init__(params)
+        self.postProcessPool = postProcessPool
+        self.progress = progress
+        self.pendingPostProcessing = []
+
+    def post_process(self, filename, ie_info):
+        self.pendingPostProcessing.append(
+            self.postProcessPool.submit(self.__postProcess, filename, ie_info))
+
+    def __postProcess(self, filename, ie_info):
+        """
+        Returns whether post processing succeeded.  Nothing else sees the
+        exception, so failures are reported here or they are lost.
+        """
+        try:
+            super().post_process(filename, ie_info)
+        except Exception as err:
+            # Ctrl-C reaches the ffmpeg children too, and that failure is just the
+            # interrupted merge
+            if not self.progress.stopped.is_set():
+                self.params['logger'].postProcessingError(ie_info.get('id'), err)
+            return False
+        return True
+
+    def waitForPostProcessing(self):
+        concurrent.futures.wait(self.pendingPostProcessing)
+        self.pendingPostProcessing = []
+
+
+class DownloadProgress(object):
+    """
+    Counts finished downloads across all worker threads, and lets the main
+    thread tell the workers to stop.
+    """
+    def __init__(self, total, quiet):
+        self.total = total
+        self.quiet = quiet
+        self.finished = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def hook(self, status):
+        if self.stopped.is_set():
+            raise KeyboardInterrupt # only the main thread sees the real one
+
+    def videoFinished(self, url):
+        # counted per url rather than from the hook, which reports every format
+        # file youtube-dl downloads before merging them.  Called from the post
+        # processing pool for videos that needed it.
+        with self.lock:
+            self.finished += 1
+            finished = self.finished
+        if not self.quiet:
+            print("Finished {}/{}: {}".format(finished, self.total, url), flush=True)
+
+
+def downloadChunk(urls, options, progress, postProcessPool):
+    logger = Logger()
+    with BackgroundPostProcessingYoutubeDL(options, postProcessPool, progress) as ydl:
+        logger.ydl = ydl # done here to reuse the default logger's nifty screen logging
+        ydl.params['logger'] = logger
+        ydl.add_progress_hook(progress.hook)
+        try:
+            for url in urls:
+                if progress.stopped.is_set():
+                    break
+                alreadyQueued = len(ydl.pendingPostProcessing)
+                ydl.download([url])
+                queued = ydl.pendingPostProcessing[alreadyQueued:]
+                if queued:
+                    # only finished once the merge is done
+                    queued[-1].add_done_callback(
+                        lambda future, url=url: future.result() and progress.videoFinished(url))
+                else:
+                    progress.videoFinished(url)
+        except KeyboardInterrupt:
+            pass # let the program finish writing its error log
+        ydl.waitForPostProcessing()
+    return logger
 
 
-def performDownload(videosToDownload, targetDirectory, noProgress):
+def performDownload(videosToDownload, targetDirectory, noProgress, workers=4):
     try:
         pathlib.Path(targetDirectory).mkdir(parents=True)
     except FileExistsError:
@@ -150,24 +288,33 @@ def performDownload(videosToDownload, targetDirectory, noProgress):
             urls.append("https://vimeo.com/{}".format(video.vidId))
     options =  {
         'ignoreerrors': True,
-        'outtmpl': "{}%(title)s - %(id)s.%(ext)s".format(targetDirectory)
+        'outtmpl': "{}%(title)s - %(id)s.%(ext)s".format(targetDirectory),
+        # several workers writing progress bars to one terminal is unreadable,
+        # so DownloadProgress reports finished videos instead
+        'noprogress': True
     }
-    if noProgress:
-        options['noprogress'] = True
+    progress = DownloadProgress(len(urls), noProgress)
+    chunks = [urls[i::workers] for i in range(workers) if urls[i::workers]]
     logger = Logger()
-    with youtube_dl.YoutubeDL(options) as ydl:
-        logger.ydl = ydl # done here to reuse the default logger's nifty screen logging
-        ydl.params['logger'] = logger
+    # ffmpeg runs in a subprocess, so these threads mostly wait; keeping the pool small
+    # leaves cpu for the downloads
+    postProcessPool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2))
+    with postProcessPool, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(downloadChunk, chunk, options, progress, postProcessPool) for chunk in chunks]
         try:
-            ydl.download(urls)
+            # an untimed wait can't be interrupted by Ctrl-C on Windows, so poll
+            while concurrent.futures.wait(futures, timeout=1).not_done:
+                pass
         except KeyboardInterrupt:
-            pass # let the program finish writing its error log
+            progress.stopped.set()
+    for future in futures:
+        logger.errors.extend(future.result().errors)
+        logger.postProcessingErrors.extend(future.result().postProcessingErrors)
     return logger
 
 
 def processErrors(logger, videosById):
-    def printError(error):
-        vidId = error.split(': ')[1]
+    def printError(vidId):
         try:
             title = videosById[vidId].title
             print("\t{} (https://www.youtube.com/watch?v={})".format(title, vidId))
@@ -176,28 +323,28 @@ def processErrors(logger, videosById):
         except KeyError:
             print("\tUnrecognized key: {}".format(vidId))
 
-    print("ERRORS OCCURRED WHILE DOWNLOADING.  Some videos may be unavailable:")
-    print("UNAVAILABLE VIDEOS:")
+    # errors look like "ERROR: <vidId>: <reason>"; split only as far as the id
+    classified = []
+    vidIdsByKind = {'unavailable': [], 'copyright': [], 'region': []}
     for error in logger.errors:
-        if "This video is unavailable." in error \
-        or "This video is no longer available" in error \
-        or "Unable to download webpage" in error:
-            printError(error)
-    print("\n")
-    print("COPYRIGHT BLOCKED VIDEOS:")
-    for error in logger.errors:
-        if "blocked it on copyright grounds" in error:
-            printError(error)
-    print("\n")
-    print("REGION BLOCKED VIDEOS:")
-    for error in logger.errors:
-        if "not available in your country" in error:
-            printError(error)
-    print("\n")
+        vidId = error.split(': ', 2)[1]
+        match = _ERR_CLASSIFIER.search(error)
+        kind = match.lastgroup if match else None
+        classified.append((error, vidId, kind))
+        if kind:
+            vidIdsByKind[kind].append(vidId)
+
+    print("ERRORS OCCURRED WHILE DOWNLOADING.  Some videos may be unavailable:")
+    for kind, heading in (('unavailable', "UNAVAILABLE VIDEOS:"),
+                          ('copyright', "COPYRIGHT BLOCKED VIDEOS:"),
+                          ('region', "REGION BLOCKED VIDEOS:")):
+        print(heading)
+        for vidId in vidIdsByKind[kind]:
+            printError(vidId)
+        print("\n")
     print("FULL ERROR LOG:")
     newlyUnavailable = set()
-    for error in logger.errors:
-        vidId = error.split(': ')[1]
+    for error, vidId, _ in classified:
         newlyUnavailable.add(vidId)
         try:
             title = videosById[vidId].title
@@ -210,25 +357,29 @@ def processErrors(logger, videosById):
         except UnicodeEncodeError:
             print("\t{}".format(error).encode('utf-8'))
             print("\t\t{} (https://www.youtube.com/watch?v={})".format(title, vidId).encode('utf-8'))
+    if len(logger.postProcessingErrors) > 0:
+        print("\n")
+        print("FAILED TO POST PROCESS (not marked unavailable; delete the leftover files to retry):")
+        for vidId, message in logger.postProcessingErrors:
+            try:
+                print("\t{}: {}".format(vidId, message))
+            except UnicodeEncodeError:
+                print("\t{}: {}".format(vidId, message).encode('utf-8'))
+            printError(vidId)
     return newlyUnavailable
 
 
 def main():
     targetDirectory = "V:/Media/berrytubeBackup/"
-    requiredPlays = 5
 
     args = parseArgs()
     if args.targetDirectory is not None:
         targetDirectory = args.targetDirectory
-    if args.requiredPlays is not None:
-        requiredPlays = args.requiredPlays
+    requiredPlays = args.requiredPlays
 
     if not targetDirectory.endswith('/'):
         targetDirectory += '/'
 
-    videosById = getVideosById()
-    print("Found {} unique videos in the chat logs.".format(len(videosById)))
-
     alreadyDownloadedIds = getAlreadyDownloadedVidIds(targetDirectory)
     if len(alreadyDownloadedIds) > 0:
         print("Found {} videos already in target directory.".format(len(alreadyDownloadedIds)))
@@ -237,7 +388,10 @@ def main():
     if len(knownUnavailableIds) > 0:
         print("Found {} known unavailable videos.".format(len(knownUnavailableIds)))
 
-    videosToDownload = filterVideos(videosById, alreadyDownloadedIds, knownUnavailableIds, requiredPlays)
+    playCounts, playedVideos = getVideoPlays()
+    print("Found {} unique videos in the chat logs.".format(len(playCounts)))
+
+    videosToDownload = filterVideos(playCounts, playedVideos, alreadyDownloadedIds | knownUnavailableIds, requiredPlays)
     if len(videosToDownload) == 0:
         print("No videos need to be downloaded.")
         return
@@ -247,13 +401,13 @@ def main():
         answer = input("Do you want to continue? (yes/no)")
         if not (answer == 'y' or answer == 'yes'):
             return
-    logger = performDownload(videosToDownload, targetDirectory, args.noProgress)
-    if len(logger.errors) > 0:
-        knownUnavailableIds.update(processErrors(logger, videosById))
+    logger = performDownload(videosToDownload, targetDirectory, args.noProgress, args.jobs)
+    if len(logger.errors) > 0 or len(logger.postProcessingErrors) > 0:
+        videosById = {v.vidId: v for v in videosToDownload}
+        knownUnavailableIds = knownUnavailableIds | processErrors(logger, videosById)
 
     with open('unavailableVideos.txt', 'w') as unavailable:
-        for vidId in knownUnavailableIds:
-            print(vidId, file=unavailable)
+        unavailable.write(''.join(vidId + '\n' for vidId in sorted(knownUnavailableIds)))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,12 @@
-from bs4 import BeautifulSoup
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import re
 import requests
-import urllib
+from requests.adapters import HTTPAdapter
 import sys
 import time
 from functools import wraps
@@ -47,28 +53,116 @@ def retry(exceptions, tries=4, delay=3, backoff=2, logger=None):
 
 class ChatLogReader(object):
     chatLogUrl = "https://logs.multihoofdrinking.com/"
+    cacheDirectory = pathlib.Path("~/.cache/btbackup").expanduser()
+    # log files downloaded at once; most are small or answered from the cache with
+    # a 304, so the fetch is bound by round trips rather than bandwidth
+    maxConcurrentFetches = 16
+    # (connect, read) seconds; without one a stalled connection would hang the
+    # in-order prefetch for good and the retries below would never fire
+    requestTimeout = (10, 60)
+    # the index page is a plain directory listing, so the links can be pulled out
+    # without building a DOM
+    logFileLinkRegex = re.compile(rb'''href=["']([^"']*log)["']''')
 
+    def __init__(self):
+        # every log file comes from the same host, so reuse connections instead of
+        # doing a fresh TCP + TLS handshake per file
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.maxConcurrentFetches)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    @retry((TimeoutError, requests.exceptions.Timeout), tries=5, delay=3, backoff=2)
     def __listLogFileUrls(self):
-        page = requests.get(self.chatLogUrl).text
-        soup = BeautifulSoup(page, 'html.parser')
-        return (node.get('href') for node in soup.find_all('a') if node.get('href').endswith('log'))
+        page = self._session.get(self.chatLogUrl, timeout=self.requestTimeout).content
+        return (href.decode('utf-8') for href in self.logFileLinkRegex.findall(page))
 
-    @retry(TimeoutError, tries=5, delay=3, backoff=2)
+    @retry((TimeoutError, requests.exceptions.Timeout), tries=5, delay=3, backoff=2)
     def __readLogFile(self, logFileUrl):
-        logFile = urllib.request.urlopen(logFileUrl)
-        for line in logFile:
-            yield line
+        """
+        Old logs never change, so keep a copy of every log file on disk and only
+        download it again if the server says it has changed.
+        """
+        cacheName = hashlib.sha1(logFileUrl.encode('utf-8')).hexdigest()
+        cachedLog = self.cacheDirectory / (cacheName + '.log')
+        cachedMeta = self.cacheDirectory / (cacheName + '.meta')
+        response = self._session.get(logFileUrl, headers=self.__cacheHeaders(cachedLog, cachedMeta),
+                                    timeout=self.requestTimeout)
+        if response.status_code == 304:
+            try:
+                return cachedLog.read_bytes()
+            except OSError:
+                # gone or unreadable since we checked; fall back to a full download
+                response = self._session.get(logFileUrl, timeout=self.requestTimeout)
+        response.raise_for_status()
+        self.__writeCache(cachedLog, cachedMeta, response)
+        return response.content
+
+    def __cacheHeaders(self, cachedLog, cachedMeta):
+        """
+        Conditional GET headers for a cached log file.  The cache is only an
+        optimisation, so anything wrong with it just means a full download.
+        """
+        try:
+            meta = json.loads(cachedMeta.read_text())
+            if not cachedLog.is_file():
+                return {}
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(meta, dict):
+            return {}
+        headers = {}
+        for key, header in (('etag', 'If-None-Match'), ('lastModified', 'If-Modified-Since')):
+            if isinstance(meta.get(key), str) and meta[key]:
+                headers[header] = meta[key]
+        return headers
+
+    def __writeCache(self, cachedLog, cachedMeta, response):
+        meta = {
+            'etag': response.headers.get('ETag'),
+            'lastModified': response.headers.get('Last-Modified')
+        }
+        if not (meta['etag'] or meta['lastModified']):
+            return # nothing to revalidate against next time
+        try:
+            self.cacheDirectory.mkdir(parents=True, exist_ok=True)
+            # write to temporary files first so an interrupted run can't leave a
+            # truncated log behind a valid ETag
+            for path, data in ((cachedLog, response.content), (cachedMeta, json.dumps(meta).encode('utf-8'))):
+                temporary = path.with_suffix(path.suffix + '.tmp')
+                temporary.write_bytes(data)
+                os.replace(str(temporary), str(path))
+        except OSError as error:
+            print("Unable to cache log file: {}".format(error))
+
+    def __prefetchLogFiles(self, logFileUrls, prefetch=None):
+        """
+        Download up to `prefetch` log files ahead of the one being read, so
+        parsing a file overlaps with downloading the next ones.
+        Yields (url, future) pairs in the order of logFileUrls.
+        """
+        if prefetch is None:
+            prefetch = self.maxConcurrentFetches
+        with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch) as pool:
+            pending = collections.deque()
+            for logFileUrl in logFileUrls:
+                pending.append((logFileUrl, pool.submit(self.__readLogFile, logFileUrl)))
+                if len(pending) > prefetch:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
 
     def listAllLogLines(self):
         logfileUrls = self.__listLogFileUrls()
-        for logFileUrl in logfileUrls:
+        for logFileUrl, logFile in self.__prefetchLogFiles(logfileUrls):
             print("Reading {}".format(logFileUrl))
             try:
-                for line in self.__readLogFile(logFileUrl):
-                    yield line
-            except urllib.error.URLError as error:
+                lines = logFile.result().splitlines()
+            except requests.exceptions.RequestException as error:
                 print(error)
                 continue
+            for line in lines:
+                yield line
 
     def listAllAdminLines(self):
         """